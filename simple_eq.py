@@ -1,12 +1,26 @@
-from flask import Flask, render_template_string, request, send_file, jsonify
+from flask import Flask, Response, render_template_string, request, send_file, jsonify
 import numpy as np
-import librosa
 import soundfile as sf
 from scipy import signal
+from numba import njit, types, float32, float64
 import os
+import io
+import uuid
+import threading
+import struct
 import tempfile
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.utils import secure_filename
 
+# CuPy is optional; long files are filtered on the GPU when it is installed
+try:
+    import cupy as cp
+    from cupyx.scipy import signal as cusignal
+except ImportError:
+    cp = None
+
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024
 
@@ -31,7 +45,7 @@ HTML_TEMPLATE = '''
     <div class="container">
         <h1>🎵 3-Band Audio EQ</h1>
         
-        <input type="file" id="audioFile" accept=".wav,.mp3,.m4a,.aac,.flac,audio/*" style="margin: 20px 0;">
+        <input type="file" id="audioFile" accept=".wav,.mp3,.flac,.ogg,audio/*" style="margin: 20px 0;">
         <div id="fileInfo"></div>
         
         <div class="control">
@@ -49,6 +63,10 @@ HTML_TEMPLATE = '''
             <input type="range" id="highGain" class="slider" min="-12" max="12" step="0.1" value="0">
         </div>
         
+        <div class="control">
+            <label><input type="checkbox" id="linearPhase"> Linear phase (FIR crossover)</label>
+        </div>
+        
         <div style="text-align: center;">
             <button id="resetBtn" class="btn">Reset</button>
             <button id="processBtn" class="btn" disabled>Apply EQ</button>
@@ -60,7 +78,9 @@ HTML_TEMPLATE = '''
 
     <script>
         let currentFilename = null;
+        let currentToken = null;
         let processedFilename = null;
+        let processedUrl = null;
         
         // Update slider displays
         ['lowGain', 'midGain', 'highGain'].forEach((id, i) => {
@@ -85,6 +105,7 @@ HTML_TEMPLATE = '''
                 
                 if (result.success) {
                     currentFilename = result.filename;
+                    currentToken = result.token;
                     document.getElementById('fileInfo').innerHTML = `<strong>Loaded:</strong> ${result.filename}`;
                     document.getElementById('processBtn').disabled = false;
                     document.getElementById('status').textContent = 'File loaded! Adjust EQ and click Apply.';
@@ -106,18 +127,24 @@ HTML_TEMPLATE = '''
                     headers: { 'Content-Type': 'application/json' },
                     body: JSON.stringify({
                         filename: currentFilename,
+                        token: currentToken,
                         low_gain: document.getElementById('lowGain').value,
                         mid_gain: document.getElementById('midGain').value,
-                        high_gain: document.getElementById('highGain').value
+                        high_gain: document.getElementById('highGain').value,
+                        linear_phase: document.getElementById('linearPhase').checked,
+                        stream: true
                     })
                 });
                 
-                const result = await response.json();
-                if (result.success) {
-                    processedFilename = result.processed_filename;
+                // Success streams the WAV back; errors still come back as JSON
+                if (response.headers.get('Content-Type').startsWith('audio/wav')) {
+                    if (processedUrl) URL.revokeObjectURL(processedUrl);
+                    processedUrl = URL.createObjectURL(await response.blob());
+                    processedFilename = `eq_${currentFilename.split('.')[0]}.wav`;
                     document.getElementById('downloadBtn').disabled = false;
                     document.getElementById('status').textContent = '✅ EQ applied! Click Download.';
                 } else {
+                    const result = await response.json();
                     document.getElementById('status').textContent = 'Error: ' + result.error;
                 }
             } catch (error) {
@@ -127,7 +154,11 @@ HTML_TEMPLATE = '''
         
         // Download
         document.getElementById('downloadBtn').onclick = () => {
-            if (processedFilename) window.location.href = `/download/${processedFilename}`;
+            if (!processedUrl) return;
+            const link = document.createElement('a');
+            link.href = processedUrl;
+            link.download = processedFilename;
+            link.click();
         };
         
         // Reset
@@ -142,26 +173,248 @@ HTML_TEMPLATE = '''
 
 temp_dir = tempfile.mkdtemp()
 
-def apply_eq(audio, sr, low_gain, mid_gain, high_gain):
+# Decoded uploads as (audio, sr), keyed by the token /upload hands out, least recently used first.
+# Bounded by decoded size: a 50 MB MP3 can decode to over 1 GB of float32.
+audio_cache = OrderedDict()
+cache_bytes = 0
+cache_lock = threading.Lock()
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Background work that can overlap with decoding
+executor = ThreadPoolExecutor(max_workers=2)
+
+# libsndfile encoding for write_wav, shared by concurrent requests. write_wav keeps at
+# most one block per file in flight, so each file's blocks still land in order.
+writer = ThreadPoolExecutor(max_workers=4)
+
+# Samples per filtering block (64 KiB of float32 stereo audio)
+BLOCK_SIZE = 8192
+
+# Files shorter than this many samples aren't worth the round trip to the GPU
+GPU_MIN_SAMPLES = 1_000_000
+
+def use_gpu(audio):
+    return cp is not None and len(audio) > GPU_MIN_SAMPLES and cp.cuda.is_available()
+
+def linkwitz_riley(wn, btype):
+    # 4th-order Linkwitz-Riley low- or high-pass: an order-2 Butterworth section, twice
+    sos = signal.butter(2, wn, btype=btype, output='sos')
+    return np.vstack([sos, sos])
+
+def allpass(wn):
+    # Second-order all-pass equal to the Linkwitz-Riley low-pass plus high-pass at wn
+    a = signal.butter(2, wn, output='sos')[0, 3:]
+    return np.concatenate([a[::-1], a])[None, :]
+
+# Sections in the widest band (two Linkwitz-Riley pairs), the same at every sample rate
+SECTIONS = 4
+
+@lru_cache(maxsize=8)
+def design_filters(sr):
+    # Second-order sections for the low, mid and high bands at this sample rate.
+    # Linkwitz-Riley crossovers sum to an all-pass even when filtered causally; the
+    # low band gets the 4 kHz all-pass the other two bands pick up from its split,
+    # so flat gains leave the magnitude response untouched.
     nyquist = sr / 2
+    low_wn = min(250, nyquist-1) / nyquist
+    high_wn = min(4000, nyquist-1) / nyquist
+    sos_low = np.vstack([linkwitz_riley(low_wn, 'low'), allpass(high_wn)])
+    sos_mid = np.vstack([linkwitz_riley(low_wn, 'high'), linkwitz_riley(high_wn, 'low')])
+    sos_high = np.vstack([linkwitz_riley(low_wn, 'high'), linkwitz_riley(high_wn, 'high')])
+    return sos_low, sos_mid, sos_high
+
+def kernel_source(sections, channels):
+    # Source for a filter kernel specialized to this many sections and channels.
+    # x and out are (samples, channels); every (band, channel) pair is a lane,
+    # lane = band * channels + channel. Each sample is copied into its lanes, then
+    # all lanes step through the Direct-Form-II-Transposed sections together. With
+    # the sections unrolled and the lane count a constant, every loop below has a
+    # fixed trip count that LLVM can fully unroll and vectorize. zi carries the
+    # state over to the next block, and the block's peak magnitude is returned so
+    # normalization needs no extra pass. Samples are float32 in memory, but the
+    # biquad updates run in float64: at high sample rates the 250 Hz poles sit so
+    # close to the unit circle that float32 state rises well above the 16-bit noise floor.
+    lanes = 3 * channels
+    lines = ['def kernel(x, out, sos, zi, gains):',
+             f'    v = np.empty({lanes}, dtype=np.float64)',
+             '    peak = 0.0',
+             '    for i in range(x.shape[0]):']
+    for b in range(0, lanes, channels):
+        for c in range(channels):
+            lines.append(f'        v[{b + c}] = x[i, {c}]')
+    for s in range(sections):
+        lines += [f'        for l in range({lanes}):',
+                  f'            y = sos[{s}, 0, l] * v[l] + zi[{s}, 0, l]',
+                  f'            zi[{s}, 0, l] = sos[{s}, 1, l] * v[l] - sos[{s}, 4, l] * y + zi[{s}, 1, l]',
+                  f'            zi[{s}, 1, l] = sos[{s}, 2, l] * v[l] - sos[{s}, 5, l] * y',
+                  '            v[l] = y']
+    for c in range(channels):
+        terms = ' + '.join(f'gains[{b + c}] * v[{b + c}]' for b in range(0, lanes, channels))
+        lines += [f'        y = {terms}',
+                  f'        out[i, {c}] = y',
+                  '        peak = max(peak, abs(y))']
+    lines.append('    return peak')
+    return '\n'.join(lines) + '\n'
+
+# Explicit kernel signatures so each kernel is compiled when it is built rather
+# than on first call. Input blocks may be read-only cached uploads.
+lane_type = float64[:, :, ::1]
+kernel_signatures = [float64(x_type, float32[:, ::1], lane_type, lane_type, float64[::1])
+                     for x_type in (float32[:, ::1], types.Array(float32, 2, 'C', readonly=True))]
+
+@lru_cache(maxsize=8)
+def make_kernel(sections, channels):
+    # Generated source has no file for Numba's on-disk cache, so compile in memory, without the GIL
+    namespace = {'np': np}
+    exec(kernel_source(sections, channels), namespace)
+    return njit(kernel_signatures, fastmath=True, nogil=True)(namespace['kernel'])
+
+def initial_state(sos, first):
+    # Steady-state filter state for a signal starting at each channel's first sample
+    return signal.sosfilt_zi(sos)[:, :, None] * first
+
+@lru_cache(maxsize=8)
+def lane_filters(sr, channels):
+    # Every (band, channel) pair gets its own lane, lane = band * channels + channel,
+    # in a (sections, 6, lanes) coefficient array. Bands with fewer sections are
+    # padded with pass-through sections so all lanes share one loop.
+    bands = design_filters(sr)
+    packed = np.zeros((max(len(sos) for sos in bands), 6, 3 * channels))
+    packed[:, 0] = 1
+    packed[:, 3] = 1
+    for b, sos in enumerate(bands):
+        packed[:len(sos), :, b * channels:(b + 1) * channels] = sos[:, :, None]
+    return packed
+
+def warm_kernels():
+    # Compile the mono and stereo kernels in the background as the server starts, so no
+    # request waits on Numba. Each kernel takes about a second (two signatures) and is
+    # rebuilt on every start, since generated source gets no on-disk cache; other
+    # channel counts compile on first use.
+    for channels in (1, 2):
+        executor.submit(make_kernel, SECTIONS, channels)
+
+warm_kernels()
+
+def lane_state(sr, first):
+    # Initial filter state in the same lane layout; pass-through sections start at rest
+    bands = design_filters(sr)
+    channels = len(first)
+    zi = np.zeros((max(len(sos) for sos in bands), 2, 3 * channels))
+    for b, sos in enumerate(bands):
+        zi[:len(sos), :, b * channels:(b + 1) * channels] = initial_state(sos, first)
+    return zi
+
+def iir_eq(audio, sr, g_low, g_mid, g_high):
+    channels = audio.shape[1]
+    sos = lane_filters(sr, channels)
+    zi = lane_state(sr, audio[0])
+    kernel = make_kernel(len(sos), channels)
+    gains = np.repeat(np.array([g_low, g_mid, g_high], dtype=np.float64), channels)
     
-    # Design filters
-    b_low, a_low = signal.butter(4, min(250, nyquist-1) / nyquist, btype='low')
-    b_mid, a_mid = signal.butter(4, [max(250, 1)/nyquist, min(4000, nyquist-1)/nyquist], btype='band')
-    b_high, a_high = signal.butter(4, max(4000, 1) / nyquist, btype='high')
-    
-    # Apply filters and gains
-    low_band = signal.filtfilt(b_low, a_low, audio) * (10 ** (low_gain / 20))
-    mid_band = signal.filtfilt(b_mid, a_mid, audio) * (10 ** (mid_gain / 20))
-    high_band = signal.filtfilt(b_high, a_high, audio) * (10 ** (high_gain / 20))
-    
-    # Combine and normalize
-    processed = low_band + mid_band + high_band
-    max_val = np.max(np.abs(processed))
-    if max_val > 1.0:
-        processed = processed / max_val
+    # Filter cache-sized blocks straight into one output buffer
+    processed = np.empty_like(audio)
+    peak = 0.0
+    for start in range(0, len(audio), BLOCK_SIZE):
+        block = slice(start, start + BLOCK_SIZE)
+        peak = max(peak, kernel(audio[block], processed[block], sos, zi, gains))
+    return processed, peak
+
+def gpu_iir_eq(audio, sr, g_low, g_mid, g_high):
+    # Whole-file filtering on the GPU: one upload, three on-device sosfilt passes
+    # summed in place, and one download. The low band's output doubles as the
+    # accumulator, so only one other band buffer is alive at a time.
+    x = cp.asarray(audio)
+    processed = None
+    for sos, gain in zip(design_filters(sr), (g_low, g_mid, g_high)):
+        zi = cp.asarray(initial_state(sos, audio[0]))
+        band, _ = cusignal.sosfilt(cp.asarray(sos), x, axis=0, zi=zi)
+        band *= gain
+        if processed is None:
+            processed = band
+        else:
+            processed += band
+        del band
+    processed = processed.astype(cp.float32, copy=False)
+    peak = float(max(processed.max(), -processed.min()))
+    return cp.asnumpy(processed), peak
+
+@lru_cache(maxsize=8)
+def design_fir(sr):
+    # Linear-phase FIR bands at this sample rate, about 16 ms long so the 250 Hz
+    # crossover stays sharp. The mid band is whatever the other two leave out, so
+    # the three sum to a pure delay and flat gains reconstruct the input exactly.
+    numtaps = 4 * (sr // 250) + 1
+    nyquist = sr / 2
+    h_low = signal.firwin(numtaps, min(250, nyquist-1), fs=sr)
+    h_high = signal.firwin(numtaps, min(4000, nyquist-1), fs=sr, pass_zero=False)
+    h_mid = -h_low - h_high
+    h_mid[numtaps // 2] += 1
+    return h_low.astype(np.float32), h_mid.astype(np.float32), h_high.astype(np.float32)
+
+def fir_eq(audio, sr, g_low, g_mid, g_high):
+    # The gained bands combine into a single FIR, applied in one overlap-add convolution
+    h_low, h_mid, h_high = design_fir(sr)
+    h = g_low * h_low + g_mid * h_mid + g_high * h_high
+    if use_gpu(audio):
+        processed = cp.asnumpy(cusignal.oaconvolve(cp.asarray(audio), cp.asarray(h)[:, None], mode='same', axes=0))
+    else:
+        processed = signal.oaconvolve(audio, h[:, None], mode='same', axes=0)
+    processed = processed.astype(np.float32, copy=False)
+    return processed, max(processed.max(), -processed.min())
+
+def apply_eq(audio, sr, low_gain, mid_gain, high_gain, linear_phase=False):
+    # Keep audio in float32 to halve memory traffic; filters keep float64 coefficients and state
+    audio = audio.astype(np.float32, copy=False)
+    g_low, g_mid, g_high = (np.float32(10 ** (gain / 20)) for gain in (low_gain, mid_gain, high_gain))
     
-    return processed
+    # Returns the unnormalized output and its peak; write_wav does the normalizing
+    if linear_phase:
+        return fir_eq(audio, sr, g_low, g_mid, g_high)
+    if use_gpu(audio):
+        return gpu_iir_eq(audio, sr, g_low, g_mid, g_high)
+    return iir_eq(audio, sr, g_low, g_mid, g_high)
+
+def normalized_blocks(processed, peak):
+    # Yield output blocks, normalizing each in place on the way out if the peak would clip
+    for start in range(0, len(processed), BLOCK_SIZE):
+        block = processed[start:start + BLOCK_SIZE]
+        if peak > 1.0:
+            block *= np.float32(1.0 / peak)
+        yield block
+
+def write_wav(path, processed, sr, peak):
+    # Encode block by block instead of handing libsndfile the whole buffer at once.
+    # libsndfile encodes one block on a writer thread while the next is prepared.
+    with sf.SoundFile(path, 'w', samplerate=sr, channels=processed.shape[1], subtype='PCM_16') as f:
+        pending = None
+        try:
+            for block in normalized_blocks(processed, peak):
+                if pending is not None:
+                    pending.result()
+                pending = writer.submit(f.write, block)
+        finally:
+            # The file must not close under a write still in flight
+            if pending is not None:
+                pending.result()
+
+def wav_header(sr, channels, frames):
+    # Canonical 44-byte PCM_16 WAV header; the length is known up front so it can go out first
+    data_size = frames * channels * 2
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + data_size, b'WAVE', b'fmt ', 16, 1,
+                       channels, sr, sr * channels * 2, channels * 2, 16, b'data', data_size)
+
+def stream_wav(header, processed, sr, peak):
+    # Yield the WAV as it is encoded: the header, then each block's raw PCM_16 samples
+    yield header
+    buffer = io.BytesIO()
+    with sf.SoundFile(buffer, 'w', samplerate=sr, channels=processed.shape[1],
+                      format='RAW', subtype='PCM_16', endian='LITTLE') as f:
+        for block in normalized_blocks(processed, peak):
+            f.write(block)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
 
 @app.route('/')
 def index():
@@ -169,15 +422,33 @@ def index():
 
 @app.route('/upload', methods=['POST'])
 def upload():
+    global cache_bytes
     try:
         file = request.files['audio_file']
         filename = secure_filename(file.filename)
-        filepath = os.path.join(temp_dir, filename)
-        file.save(filepath)
         
-        # Test load
-        librosa.load(filepath, sr=None)
-        return jsonify({'success': True, 'filename': filename})
+        # Reject from the header alone anything whose float32 decode wouldn't fit the cache
+        info = sf.info(file.stream)
+        if info.frames * info.channels * 4 > CACHE_MAX_BYTES:
+            return jsonify({'error': 'Audio is too long to process'})
+        
+        # Design this sample rate's filters while the file decodes, so /process finds them cached
+        design = executor.submit(design_filters, info.samplerate)
+        file.stream.seek(0)
+        
+        # Decode straight from the upload once and keep the (samples, channels) array in memory
+        audio, sr = sf.read(file.stream, dtype='float32', always_2d=True)
+        audio.flags.writeable = False
+        design.result()
+        
+        token = uuid.uuid4().hex
+        with cache_lock:
+            audio_cache[token] = (audio, sr)
+            cache_bytes += audio.nbytes
+            while cache_bytes > CACHE_MAX_BYTES:
+                _, (evicted, _) = audio_cache.popitem(last=False)
+                cache_bytes -= evicted.nbytes
+        return jsonify({'success': True, 'filename': filename, 'token': token})
     except Exception as e:
         return jsonify({'error': str(e)})
 
@@ -185,15 +456,31 @@ def upload():
 def process():
     try:
         data = request.json
-        filepath = os.path.join(temp_dir, data['filename'])
-        audio, sr = librosa.load(filepath, sr=None)
         
-        processed = apply_eq(audio, sr, float(data['low_gain']), 
-                           float(data['mid_gain']), float(data['high_gain']))
+        # Reuse the array decoded at upload instead of touching the disk again
+        with cache_lock:
+            if data.get('token') not in audio_cache:
+                return jsonify({'error': 'Upload expired, please upload the file again'})
+            audio_cache.move_to_end(data['token'])
+            audio, sr = audio_cache[data['token']]
+        
+        processed, peak = apply_eq(audio, sr, float(data['low_gain']), 
+                           float(data['mid_gain']), float(data['high_gain']),
+                           bool(data.get('linear_phase', False)))
+        
+        # The client echoes the name back, so sanitize it again before it reaches a path or header
+        output_filename = f"eq_{secure_filename(data['filename']).split('.')[0]}.wav"
+        
+        # Stream the encoded WAV straight back instead of round-tripping through a temp file
+        if data.get('stream'):
+            header = wav_header(sr, processed.shape[1], len(processed))
+            response = Response(stream_wav(header, processed, sr, peak), mimetype='audio/wav')
+            response.headers['Content-Length'] = str(len(header) + processed.size * 2)
+            response.headers.set('Content-Disposition', 'attachment', filename=output_filename)
+            return response
         
-        output_filename = f"eq_{data['filename'].split('.')[0]}.wav"
         output_path = os.path.join(temp_dir, output_filename)
-        sf.write(output_path, processed, sr)
+        write_wav(output_path, processed, sr, peak)
         
         return jsonify({'success': True, 'processed_filename': output_filename})
     except Exception as e:
@@ -205,5 +492,5 @@ def download(filename):
 
 if __name__ == '__main__':
     print("🎵 Starting Audio EQ Server...")
-    print("📁 Install packages first: pip install flask librosa soundfile scipy numpy")
+    print("📁 Install packages first: pip install flask soundfile scipy numpy numba")
     app.run(host='0.0.0.0', port=5000, debug=True)